@@ -1,166 +1,419 @@
 import socket
+import struct
+import logging
+import threading
 import time
-from utils import in_range
+from bisect import bisect_left
+from collections import OrderedDict
+import mmsg
+import protocol
+from utils import Peer, in_range
+
+log = logging.getLogger(__name__)
+
+# Pre-packed RPC requests without payload; call_many fills in the token.
+_PING = protocol.pack_header(protocol.PING)
+_HEARTBEAT = protocol.pack_header(protocol.HEARTBEAT_REQUEST)
+
+def _find_successor_request(id):
+    return protocol.pack_id_message(protocol.FIND_SUCCESSOR, 0, id)
 
 class Chord:
-    def __init__(self, node, m=8):
+    def __init__(self, node, m=8, cache_size=256, cache_ttl=5, alpha=3, liveness_window=15,
+                 finger_update_interval=1):
         """
         :param node: The Node instance using this Chord instance.
         :param m: The number of bits in the key (ID) space.
+        :param alpha: How many preceding fingers a lookup started here queries in parallel.
+        :param cache_size: Maximum number of remote lookup results to cache.
+        :param cache_ttl: Seconds a cached lookup result stays valid (one stabilization period).
+        :param liveness_window: Seconds a peer that answered one of our RPCs counts as
+                                alive without being pinged (three stabilization periods).
+        :param finger_update_interval: Minimum seconds between two finger table refreshes.
         """
         self.node = node
         self.m = m
+        self.alpha = alpha
         self.finger_table = [None] * m
+        # The ID space is fixed at construction, so precompute its size, the
+        # mask that replaces "% 2**m", and the finger offsets 2**i.
+        self._ring_size = 1 << m
+        self._ring_mask = self._ring_size - 1
+        self._powers = [1 << i for i in range(m)]
+        # Fingers sorted by clockwise distance from this node, kept as two
+        # parallel lists (distances, fingers) so bisect compares plain ints.
+        # Rebuilt whenever the table changes and swapped in as one tuple.
+        self._finger_index = ([], [])
+        # Debounces update_finger_table.
+        self.finger_update_interval = finger_update_interval
+        self._last_finger_update = float("-inf")
+        self._finger_update_lock = threading.Lock()
+
+        # LRU cache of remote find_successor results:
+        # id -> (expiry time, cache version, successor). Bumping the version
+        # invalidates every entry at once, including results of lookups that
+        # were still in flight when the ring changed.
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_version = 0
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache_hits = 0
+        self.cache_misses = 0
 
-    def find_successor(self, id):
+        # Long-lived RPC sockets, one per calling thread so the listener is never
+        # stuck behind a stabilization round-trip. Tokens match replies to requests.
+        self._rpc_local = threading.local()
+        self._rpc_socks = []
+        self._rpc_lock = threading.Lock()
+        self._rpc_token = 0
+        # id -> time.monotonic() of the last reply received from that peer.
+        self.liveness_window = liveness_window
+        self._last_seen = {}
+        # Ids that failed the last prune's ping; stabilize won't adopt them
+        # even if our successor still names one as its predecessor.
+        self._failed = set()
+        # Whether the last stabilize saw our successor name us as its
+        # predecessor, in which case a NOTIFY would change nothing.
+        self.successor_knows_us = False
+
+    def find_successor(self, id, alpha=None):
         """
         Synchronously find the successor node responsible for the given id.
         If the id falls between this node and its current successor, return the successor.
-        Otherwise, query the closest preceding node.
+        Otherwise, query the alpha closest preceding nodes in parallel and take
+        the first answer; alpha defaults to self.alpha. Lookups forwarded from
+        other nodes should pass alpha=1 so the fan-out happens only once.
+        """
+        version = self._cache_version
+        succ = self._find_successor_locally(id)
+        if succ is not None:
+            return succ
+        candidates = self.closest_preceding_nodes(id, alpha or self.alpha)
+        if not candidates:
+            candidates = [self.node.successor]
+        if len(candidates) == 1:
+            # Use a synchronous RPC call to candidate to continue the lookup.
+            succ = self.rpc_find_successor(candidates[0], id)
+        else:
+            succ = None
+            replies = self.call_many([(candidate, _find_successor_request(id)) for candidate in candidates],
+                                     wait_all=False)
+            for reply in replies:
+                if reply and reply[0] == protocol.SUCCESSOR:
+                    succ = reply[1]
+        if succ is None:
+            # If RPC fails, fall back to the closest candidate.
+            return candidates[0]
+        else:
+            self._cache_put(id, succ, version)
+            return succ
+
+    def find_successors(self, ids):
+        """
+        Find the successors of several ids at once. Ids that need an RPC are
+        sent to their closest preceding nodes together and the replies are
+        collected in a single wait, so the batch costs about one lookup
+        round-trip instead of one per id.
+        """
+        version = self._cache_version
+        results = [self._find_successor_locally(id) for id in ids]
+        missing = [i for i, succ in enumerate(results) if succ is None]
+        candidates = [self.closest_preceding_node(ids[i]) or self.node.successor for i in missing]
+        replies = self.call_many([(candidate, _find_successor_request(ids[i]))
+                                  for i, candidate in zip(missing, candidates)])
+        for i, candidate, reply in zip(missing, candidates, replies):
+            if reply and reply[0] == protocol.SUCCESSOR:
+                results[i] = reply[1]
+                self._cache_put(ids[i], reply[1], version)
+            else:
+                # If RPC fails, fall back to the candidate.
+                results[i] = candidate
+        return results
+
+    def _find_successor_locally(self, id):
+        """
+        Return the successor of id if it is known without an RPC (we are alone,
+        id is in (node.id, successor.id], or the answer is cached), else None.
         """
         # Special case: only one node in the ring.
-        if self.node.id == self.node.successor["id"]:
+        if self.node.id == self.node.successor.id:
             return self.node.successor
 
         # Check if id is in (node.id, successor.id] (inclusive on the end)
-        if in_range(id, self.node.id, self.node.successor["id"], include_end=True):
+        if in_range(id, self.node.id, self.node.successor.id, include_end=True):
             return self.node.successor
-        else:
-            candidate = self.closest_preceding_node(id)
-            if candidate is None:
-                candidate = self.node.successor
-            # Use a synchronous RPC call to candidate to continue the lookup.
-            succ = self.rpc_find_successor(candidate, id)
-            if succ is None:
-                # If RPC fails, fall back to the candidate.
-                return candidate
-            else:
-                return succ
+        return self._cache_get(id)
+
+    def _cache_get(self, id):
+        """Return the cached successor of id, or None if missing, expired or invalidated."""
+        with self._cache_lock:
+            entry = self._cache.get(id)
+            if entry is not None and entry[1] == self._cache_version and entry[0] > time.monotonic():
+                self._cache.move_to_end(id)
+                self.cache_hits += 1
+                return entry[2]
+            self.cache_misses += 1
+            return None
+
+    def _cache_put(self, id, succ, version):
+        """Cache a lookup result, unless the cache was invalidated since version was read."""
+        with self._cache_lock:
+            if version != self._cache_version:
+                return
+            self._cache[id] = (time.monotonic() + self.cache_ttl, version, succ)
+            self._cache.move_to_end(id)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def clear_cache(self):
+        """Invalidate all cached lookups; called when the ring around this node changes."""
+        with self._cache_lock:
+            self._cache_version += 1
 
     def closest_preceding_node(self, id):
         """
         Return the closest finger preceding the id.
         """
-        # Traverse the finger table in reverse order.
-        for finger in reversed(self.finger_table):
-            if finger and in_range(finger["id"], self.node.id, id):
-                return finger
-        return None
+        nodes = self.closest_preceding_nodes(id, 1)
+        return nodes[0] if nodes else None
+
+    def closest_preceding_nodes(self, id, count):
+        """
+        Return up to count distinct fingers preceding the id, closest first.
+        """
+        # Binary search for the farthest finger that is still short of id.
+        # id == node.id stands for the whole ring, hence the -1/+1.
+        target = ((id - self.node.id - 1) & self._ring_mask) + 1
+        dists, nodes = self._finger_index
+        i = bisect_left(dists, target) - 1
+        found = []
+        while i >= 0 and dists[i] > 0 and len(found) < count:
+            # Equal fingers sit next to each other in the sorted index.
+            if not found or nodes[i].id != found[-1].id:
+                found.append(nodes[i])
+            i -= 1
+        return found
+
+    def _rebuild_finger_index(self):
+        node_id = self.node.id
+        mask = self._ring_mask
+        index = sorted(
+            ((finger.id - node_id) & mask, i)
+            for i, finger in enumerate(self.finger_table) if finger
+        )
+        self._finger_index = ([dist for dist, _ in index],
+                              [self.finger_table[i] for _, i in index])
+
+    def reset_finger_table(self):
+        """Point every finger back at this node, as when it is alone in the ring."""
+        self.finger_table = [self.node.successor for _ in range(self.m)]
+        self._rebuild_finger_index()
 
     def update_finger_table(self):
         """
         Refresh all entries in the finger table.
         For each entry i, compute start = (node.id + 2^i) mod 2^m
-        and use find_successor(start) to fill in the finger table.
-        """
-        for i in range(self.m):
-            start = (self.node.id + 2 ** i) % (2 ** self.m)
-            succ = self.find_successor(start)
-            if succ:
-                self.finger_table[i] = {
-                    "ip": succ["ip"],
-                    "port": succ["port"],
-                    "id": succ["id"]
-                }
-            else:
-                self.finger_table[i] = None
+        and use find_successors to look up all starts in one batch.
+        Calls made while a refresh is running, or within finger_update_interval
+        of the last one, return without doing anything.
+        """
+        if not self._finger_update_lock.acquire(blocking=False):
+            return
+        try:
+            now = time.monotonic()
+            if now - self._last_finger_update < self.finger_update_interval:
+                return
+            self._last_finger_update = now
+            old_ids = [finger.id if finger else None for finger in self.finger_table]
+            node_id = self.node.id
+            mask = self._ring_mask
+            starts = [(node_id + power) & mask for power in self._powers]
+            for i, succ in enumerate(self.find_successors(starts)):
+                # Peers are never modified in place, so fingers can share them.
+                self.finger_table[i] = succ or None
+            self._rebuild_finger_index()
+            new_ids = [finger.id if finger else None for finger in self.finger_table]
+            if new_ids != old_ids:
+                self.clear_cache()
+        finally:
+            self._finger_update_lock.release()
 
     def rpc_find_successor(self, candidate, id):
         """
         Synchronously ask the candidate node for the successor of the given id.
-        This method creates a temporary UDP socket, sends a FIND_SUCCESSOR request,
-        and waits for the SUCCESSOR reply.
+        Sends a FIND_SUCCESSOR request over the RPC socket and waits for the
+        SUCCESSOR reply.
         """
         try:
-            temp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            temp_sock.settimeout(2)  # Wait up to 2 seconds for a reply.
-            # Bind to an ephemeral port.
-            temp_sock.bind(('', 0))
-            message = f"FIND_SUCCESSOR {id}"
-            temp_sock.sendto(message.encode(), (candidate["ip"], candidate["port"]))
-            data, _ = temp_sock.recvfrom(1024)
-            parts = data.decode().split()
-            if parts[0] == "SUCCESSOR":
-                succ = {"ip": parts[1], "port": int(parts[2]), "id": int(parts[3])}
-                temp_sock.close()
-                return succ
+            reply = self.call(candidate, _find_successor_request(id))
+            if reply and reply[0] == protocol.SUCCESSOR:
+                return reply[1]
         except Exception as e:
-            print(f"[Chord.rpc_find_successor] Error contacting candidate {candidate}: {e}")
+            log.warning("[Chord.rpc_find_successor] Error contacting candidate %s: %s", candidate, e)
         return None
-    
-    def is_node_alive(self, node_info, timeout=1):
-        """Synchronous ping to check if a node is alive."""
+
+    def call(self, target, message, timeout=2):
+        """
+        Send a request to the target over the RPC socket and wait for its reply.
+        The request carries a token and the reply echoes it back, so
+        late replies to earlier (timed out) requests are discarded.
+        Returns the reply as an (opcode, payload) pair, or None on timeout.
+        """
+        return self.call_many([(target, message)], timeout)[0]
+
+    def call_many(self, requests, timeout=2, wait_all=True):
+        """
+        Send several requests at once and wait for all of their replies, so the
+        total wait is one timeout rather than one per request.
+
+        :param requests: A list of (target, message) pairs, message being a packed request.
+        :param timeout: Seconds to wait for the replies.
+        :param wait_all: If False, return as soon as the first reply arrives.
+        :return: A list with the (opcode, payload) reply for each request, or
+                 None where no reply arrived in time.
+        """
+        sock = self._get_rpc_sock()
+        with self._rpc_lock:
+            first = self._rpc_token + 1
+            self._rpc_token = (self._rpc_token + len(requests)) & 0xFFFFFFFF
+        tokens = [(first + i) & 0xFFFFFFFF for i in range(len(requests))]
+        # All requests go out in one sendmmsg call where available.
+        sent = self._rpc_local.sender.send([(protocol.with_token(message, token), target.addr)
+                                            for token, (target, message) in zip(tokens, requests)])
+        # Requests that couldn't be sent keep a None reply.
+        pending = {token: i for i, token in enumerate(tokens) if sent[i]}
+        replies = [None] * len(requests)
+        deadline = time.monotonic() + timeout
+        # Replies are received into a pooled buffer and parsed in place.
+        buf = self.node.buffers.get()
         try:
-            temp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            temp_sock.settimeout(timeout)
-            temp_sock.bind(('', 0))
-            temp_sock.sendto("PING".encode(), (node_info["ip"], node_info["port"]))
-            data, _ = temp_sock.recvfrom(1024)
-            temp_sock.close()
-            return data.decode().strip() == "PONG"
-        except Exception as e:
-            return False
+            with memoryview(buf) as view:
+                while pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    sock.settimeout(remaining)
+                    try:
+                        nbytes, _ = sock.recvfrom_into(buf)
+                    except OSError:
+                        break
+                    data = view[:nbytes]
+                    if not protocol.is_reply(data):
+                        continue
+                    try:
+                        op, token, payload = protocol.unpack_message(data)
+                    except struct.error:
+                        continue  # Truncated reply.
+                    finally:
+                        data.release()
+                    if token in pending:
+                        i = pending.pop(token)
+                        replies[i] = (op, payload)
+                        self._last_seen[requests[i][0].id] = time.monotonic()
+                        if not wait_all:
+                            break
+        finally:
+            self.node.buffers.put(buf)
+        if wait_all:
+            # A peer that just failed to answer has to prove itself alive again.
+            for i in pending.values():
+                self._last_seen.pop(requests[i][0].id, None)
+        return replies
+
+    def _get_rpc_sock(self):
+        """Return the calling thread's RPC socket, creating it on first use."""
+        sock = getattr(self._rpc_local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('', 0))  # Bind to an ephemeral port.
+            self._rpc_local.sock = sock
+            self._rpc_local.sender = mmsg.Sender(sock)
+            with self._rpc_lock:
+                self._rpc_socks.append(sock)
+        return sock
+
+    def close(self):
+        """Close all RPC sockets."""
+        with self._rpc_lock:
+            for sock in self._rpc_socks:
+                sock.close()
+            self._rpc_socks = []
 
     def prune_successor_list(self):
         """Remove entries from the successor list that are not responding."""
         alive_list = []
+        # Entries that answered any RPC (HEARTBEAT, FIND_SUCCESSOR, ...) within the
+        # liveness window are alive; only the rest are pinged, all at once.
+        now = time.monotonic()
+        alive_ids = set()
+        stale = []
+        for entry in self.node.successor_list:
+            if entry.id == self.node.id:
+                continue
+            if now - self._last_seen.get(entry.id, float("-inf")) <= self.liveness_window:
+                alive_ids.add(entry.id)
+            else:
+                stale.append(entry)
+        failed = set()
+        if stale:
+            replies = self.call_many([(entry, _PING) for entry in stale], timeout=1)
+            for entry, reply in zip(stale, replies):
+                if reply and reply[0] == protocol.PONG:
+                    alive_ids.add(entry.id)
+                else:
+                    failed.add(entry.id)
+        self._failed = failed
         # Always keep self.node.successor_list[0] (immediate successor) if it's alive.
         for entry in self.node.successor_list:
             # If the entry is self, always keep it.
-            if entry["id"] == self.node.id:
+            if entry.id == self.node.id or entry.id in alive_ids:
                 alive_list.append(entry)
-            else:
-                if self.is_node_alive(entry):
-                    alive_list.append(entry)
         # Ensure we have at least one entry (the immediate successor)
         if alive_list:
             self.node.successor_list = alive_list
-            self.successor = self.node.successor_list[0]
+            self.node.successor = self.node.successor_list[0]
         else:
             # If no successor is alive, fallback to self.
-            self.node.successor_list = [ {"ip": self.node.ip, "port": self.node.port, "id": self.node.id} ]
+            self.node.successor_list = [Peer(self.node.ip, self.node.port, self.node.id)]
             self.node.successor = self.node.successor_list[0]
 
     def stabilize(self):
-        if self.node.successor["id"] == self.node.id and self.node.predecessor is not None and self.node.predecessor["id"] != self.node.id:
+        self.successor_knows_us = False
+        if self.node.successor.id == self.node.id and self.node.predecessor is not None and self.node.predecessor.id != self.node.id:
             self.node.successor = self.node.predecessor
             if self.node.successor_list:
                 self.node.successor_list[0] = self.node.successor
-            print(f"Node {self.node.id} updated its successor to its predecessor: {self.node.successor}")
+            log.info("Node %s updated its successor to its predecessor: %s", self.node.id, self.node.successor)
         else:
-            if self.node.successor["id"] != self.node.id:
-                self.node.temp_predecessor = None
-                self.node.send_message(self.successor["ip"], self.successor["port"], "GET_PREDECESSOR")
-                time.sleep(0.5)
-                x = self.node.temp_predecessor
-                if x and in_range(x["id"], self.node.id, self.node.successor["id"]):
+            if self.node.successor.id != self.node.id:
+                # One HEARTBEAT round-trip returns both our successor's
+                # predecessor and its successor list.
+                old_successor = self.node.successor
+                reply = self.call(old_successor, _HEARTBEAT)
+                if not (reply and reply[0] == protocol.HEARTBEAT):
+                    return
+                x, successor_list = reply[1]
+                self.successor_knows_us = x is not None and x.id == self.node.id
+                if x and x.id not in self._failed and in_range(x.id, self.node.id, old_successor.id):
                     self.node.successor = x
-                    if self.node.successor_list:
-                        self.node.successor_list[0] = self.node.successor
-                    print(f"Node {self.node.id} updated its successor to {self.node.successor} via stabilization")
-
-    def update_successor_list(self):
-        if self.node.successor["id"] != self.node.id:
-            try:
-                temp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                temp_sock.settimeout(2)
-                temp_sock.bind(('', 0))
-                temp_sock.sendto("GET_SUCCESSOR_LIST".encode(), (self.node.successor["ip"], self.node.successor["port"]))
-                data, _ = temp_sock.recvfrom(1024)
-                parts = data.decode().split()
-                if parts[0] == "SUCCESSOR_LIST":
-                    new_list = []
-                    entries = (len(parts) - 1) // 3
-                    for i in range(entries):
-                        entry_ip = parts[1 + 3*i]
-                        entry_port = int(parts[2 + 3*i])
-                        entry_id = int(parts[3 + 3*i])
-                        new_list.append({"ip": entry_ip, "port": entry_port, "id": entry_id})
-                    self.node.successor_list = [self.node.successor]
-                    for entry in new_list:
-                        if entry["id"] != self.node.id and len(self.node.successor_list) < self.node.r:
-                            self.node.successor_list.append(entry)
-                    # print(f"Node {self.node.id} updated its successor list to: {self.node.successor_list}")
-                temp_sock.close()
-            except Exception as e:
-                print(f"[stabilize] Error fetching successor list: {e}")
\ No newline at end of file
+                    self.clear_cache()
+                    successor_list = [old_successor] + successor_list
+                    log.info("Node %s updated its successor to %s via stabilization", self.node.id, self.node.successor)
+                self.merge_successor_list(successor_list)
+
+    def merge_successor_list(self, entries):
+        """
+        Rebuild the successor list as our immediate successor followed by the
+        given entries (our successor's list), skipping ourselves and nodes
+        already listed, up to r entries.
+        """
+        # Keyed by address; dicts keep insertion order, so this is also the
+        # list in ring order and each membership test is a single lookup.
+        successors = {self.node.successor.addr: self.node.successor}
+        for entry in entries:
+            if len(successors) >= self.node.r:
+                break
+            if entry.id != self.node.id:
+                successors.setdefault(entry.addr, entry)
+        self.node.successor_list = list(successors.values())
\ No newline at end of file
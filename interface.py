@@ -1,30 +1,122 @@
+import logging
 import sys
-import threading
 from node import Node
 from utils import node_info
-from prompt_toolkit import prompt
+from prompt_toolkit import PromptSession
 from prompt_toolkit.patch_stdout import patch_stdout
 
+class _StdoutHandler(logging.StreamHandler):
+    """Writes to the current sys.stdout, so log lines go through patch_stdout while the prompt is shown."""
+    def emit(self, record):
+        self.stream = sys.stdout
+        super().emit(record)
+
+# Node state changes are logged at INFO; per-message detail (received
+# datagrams, replicas) is DEBUG and never formatted at this level.
+logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[_StdoutHandler()])
+
 # Prompt for port
 ip = str(input("Ip Address: "))
 # Prompt for port
 port = int(input("Port number: "))
 node = Node(ip, port)
 
-def cli_loop():
-    while True:
+MENU = (
+    "\n=== Chord Node CLI ===\n"
+    "Commands:\n"
+    "  JOIN <ip> <port>\n"
+    "  STORE <key> <value>\n"
+    "  LOOKUP <key>\n"
+    "  LEAVE\n"
+    "  INFO\n"
+    "  HELP\n"
+    "  EXIT\n"
+)
+PROMPT = "Enter command: "
+
+def show_menu():
+    """Write the command menu in one call."""
+    sys.stdout.write(MENU)
+    sys.stdout.flush()
+
+def _do_join(args):
+    if len(args) != 2:
+        print("Usage: JOIN <ip> <port>")
+        return
+    try:
+        known_ip = args[0]
+        known_port = int(args[1])
+    except ValueError:
+        print("Error: Port must be a number.")
+        return
+    if not 0 <= known_port <= 65535:
+        print("Error: Port must be between 0 and 65535.")
+        return
+    node.join(known_ip, known_port)
+
+def _do_store(args):
+    if len(args) < 2:
+        print("Usage: STORE <key> <value>")
+        return
+    key = args[0]
+    value = " ".join(args[1:])  # Allow multi-word values
+    node.store(key, value)
+
+def _do_lookup(args):
+    if len(args) != 1:
+        print("Usage: LOOKUP <key>")
+        return
+    key = args[0]
+    node.lookup(key)
+
+def _do_leave(args):
+    node.leave()
+
+def _do_info(args):
+    node_info(node)
+
+def _do_help(args):
+    show_menu()
+
+def _do_exit(args):
+    print("Exiting...")
+    node.close()
+
+HANDLERS = {
+    "JOIN": _do_join,
+    "STORE": _do_store,
+    "LOOKUP": _do_lookup,
+    "LEAVE": _do_leave,
+    "INFO": _do_info,
+    "HELP": _do_help,
+    "EXIT": _do_exit,
+}
+
+# Created on the first interactive prompt; prompt_toolkit warns if it is
+# set up on piped input.
+session = None
+
+def read_command():
+    """
+    Read one command line. Interactive sessions get the prompt_toolkit prompt;
+    piped input is read line by line without one.
+    Returns None at end of input.
+    """
+    global session
+    if sys.stdin.isatty():
+        if session is None:
+            session = PromptSession()
         with patch_stdout():
-            user_input = prompt(
-                f"\n=== Chord Node CLI ===\n"
-                "Commands:\n"
-                "  JOIN <ip> <port>\n"
-                "  STORE <key> <value>\n"
-                "  LOOKUP <key>\n"
-                "  LEAVE\n"
-                "  INFO\n"
-                "  EXIT\n"
-                "Enter command: "
-            ).strip()
+            return session.prompt(PROMPT)
+    line = sys.stdin.readline()
+    return line if line else None
+
+def cli_loop():
+    while not node.stop_event.is_set():
+        user_input = read_command()
+        if user_input is None:
+            _do_exit([])
+            break
 
         # Split input into parts (command + arguments)
         parts = user_input.split()
@@ -34,48 +126,17 @@ def cli_loop():
         command = parts[0].upper()
         args = parts[1:]
 
-        if command == "JOIN":
-            if len(args) != 2:
-                print("Usage: JOIN <ip> <port>")
-                continue
-            try:
-                known_ip = args[0]
-                known_port = int(args[1])
-                node.join(known_ip, known_port)
-            except ValueError:
-                print("Error: Port must be a number.")
-
-        elif command == "STORE":
-            if len(args) < 2:
-                print("Usage: STORE <key> <value>")
-                continue
-            key = args[0]
-            value = " ".join(args[1:])  # Allow multi-word values
-            node.store(key, value)
-
-        elif command == "LOOKUP":
-            if len(args) != 1:
-                print("Usage: LOOKUP <key>")
-                continue
-            key = args[0]
-            node.lookup(key)
-
-        elif command == "LEAVE":
-            node.leave()
-
-        elif command == "INFO":
-            node_info(node)
-
-        elif command == "EXIT":
-            print("Exiting...")
-            node.stop_event.set()
-            node.sock.close()
-            sys.exit()
-
+        handler = HANDLERS.get(command)
+        if handler:
+            handler(args)
         else:
-            print("Invalid command. Type one of: JOIN, STORE, LOOKUP, LEAVE, INFO, EXIT.")
+            print("Invalid command. Type one of: JOIN, STORE, LOOKUP, LEAVE, INFO, HELP, EXIT.")
 
 if __name__ == "__main__":
-    cli_thread = threading.Thread(target=cli_loop, daemon=True)
-    cli_thread.start()
-    cli_thread.join()
+    # The menu is written once up front instead of redrawn with every prompt,
+    # and not at all when input is piped.
+    if sys.stdin.isatty():
+        show_menu()
+    # The CLI runs on the main thread; the node's own threads keep the ring
+    # maintained in the background.
+    cli_loop()
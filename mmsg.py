@@ -0,0 +1,202 @@
+import ctypes
+import ctypes.util
+import os
+import socket
+import struct
+import threading
+
+# Batched UDP I/O through Linux sendmmsg(2) and recvmmsg(2), so a burst of
+# datagrams costs one system call instead of one sendto/recvfrom each.
+# CPython's socket module exposes neither, so they are called through libc
+# with ctypes. Where they aren't available (other platforms, non-IPv4
+# addresses) we fall back to sendto/recvfrom with the same result.
+
+
+# Reads a packed IPv4 address back in host byte order, so storing it in the
+# in_addr field leaves the bytes in network order.
+_IN_ADDR = struct.Struct("=I")
+
+
+class _SockaddrIn(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_uint32),
+                ("sin_zero", ctypes.c_char * 8)]
+
+
+class _Iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _Msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_Iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _Mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _Msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_libc_function(name, argtypes):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        func = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = argtypes
+    func.restype = ctypes.c_int
+    return func
+
+
+_sendmmsg = _load_libc_function("sendmmsg", [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int])
+_recvmmsg = _load_libc_function("recvmmsg", [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                             ctypes.c_void_p])
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0x40)
+
+
+def _send_each(sock, datagrams):
+    sent = []
+    for data, addr in datagrams:
+        try:
+            sock.sendto(data, addr)
+            sent.append(True)
+        except OSError:
+            sent.append(False)
+    return sent
+
+
+class Sender:
+    """
+    Sends batches of datagrams from one socket, up to `count` per sendmmsg
+    call. The address slots and message headers are allocated once and reused,
+    and the iovecs point straight at the caller's bytes, so a batch isn't
+    copied before it reaches the kernel. Safe to share between threads.
+    """
+
+    def __init__(self, sock, count=32):
+        self.sock = sock
+        self._lock = threading.Lock()
+        self._batched = _sendmmsg is not None and sock.family == socket.AF_INET
+        if not self._batched:
+            return
+        self._count = count
+        self._addrs = (_SockaddrIn * count)()
+        self._iovs = (_Iovec * count)()
+        self._msgs = (_Mmsghdr * count)()
+        for i in range(count):
+            self._addrs[i].sin_family = socket.AF_INET
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._addrs[i])
+            hdr.msg_namelen = ctypes.sizeof(_SockaddrIn)
+            hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+
+    def send(self, datagrams):
+        """
+        Send several UDP datagrams.
+
+        :param datagrams: A list of (data, (ip, port)) pairs, data being bytes.
+        :return: A list of booleans telling whether each datagram was sent.
+        """
+        if len(datagrams) < 2 or not self._batched:
+            return _send_each(self.sock, datagrams)
+        sent = []
+        with self._lock:
+            for start in range(0, len(datagrams), self._count):
+                sent += self._send_batch(datagrams[start:start + self._count])
+        return sent
+
+    def _send_batch(self, datagrams):
+        n = len(datagrams)
+        try:
+            for i, (_, (ip, port)) in enumerate(datagrams):
+                self._addrs[i].sin_port = socket.htons(port)
+                self._addrs[i].sin_addr = _IN_ADDR.unpack(socket.inet_aton(ip))[0]
+        except OSError:
+            return _send_each(self.sock, datagrams)  # Not a dotted IPv4 address.
+        # c_char_p points into each bytes object; keep them referenced until sent.
+        pointers = [ctypes.c_char_p(data) for data, _ in datagrams]
+        for i, (pointer, (data, _)) in enumerate(zip(pointers, datagrams)):
+            self._iovs[i].iov_base = ctypes.cast(pointer, ctypes.c_void_p).value
+            self._iovs[i].iov_len = len(data)
+
+        sent = [False] * n
+        fd = self.sock.fileno()
+        if fd < 0:
+            return sent  # Closed.
+        i = 0
+        while i < n:
+            count = _sendmmsg(fd, ctypes.addressof(self._msgs) + i * ctypes.sizeof(_Mmsghdr), n - i, 0)
+            if count <= 0:
+                i += 1  # The datagram at i failed; carry on with the rest.
+                continue
+            for j in range(i, i + count):
+                sent[j] = True
+            i += count
+        return sent
+
+
+class Receiver:
+    """
+    Receives datagrams from one socket up to `count` at a time with a single
+    recvmmsg call. The buffers and message headers are allocated once and
+    reused for every call, and received data is handed out as views into the
+    buffers rather than copied.
+    """
+
+    def __init__(self, sock, count=32, buflen=2048):
+        self.sock = sock
+        self.buflen = buflen
+        self._batched = _recvmmsg is not None and sock.family == socket.AF_INET
+        if not self._batched:
+            self._buf = bytearray(buflen)
+            self._view = memoryview(self._buf)
+            return
+        self._count = count
+        self._bufs = (ctypes.c_char * (buflen * count))()
+        self._view = memoryview(self._bufs).cast("B")
+        self._addrs = (_SockaddrIn * count)()
+        self._iovs = (_Iovec * count)()
+        self._msgs = (_Mmsghdr * count)()
+        base = ctypes.addressof(self._bufs)
+        for i in range(count):
+            self._iovs[i].iov_base = base + i * buflen
+            self._iovs[i].iov_len = buflen
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._addrs[i])
+            hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self):
+        """
+        Receive the datagrams that are waiting, without blocking.
+
+        :return: A non-empty list of (data, (ip, port)) pairs, data being a
+                 memoryview that is only valid until the next call.
+        :raises BlockingIOError: If no datagram is waiting.
+        :raises OSError: If the socket fails or is closed.
+        """
+        if not self._batched:
+            nbytes, addr = self.sock.recvfrom_into(self._buf)
+            return [(self._view[:nbytes], addr)]
+        for i in range(self._count):
+            # The kernel overwrites the address length, so reset it every call.
+            self._msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockaddrIn)
+        n = _recvmmsg(self.sock.fileno(), ctypes.addressof(self._msgs), self._count, _MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))  # EAGAIN becomes BlockingIOError.
+        received = []
+        for i in range(n):
+            addr = self._addrs[i]
+            start = i * self.buflen
+            data = self._view[start:start + self._msgs[i].msg_len]
+            received.append((data, (socket.inet_ntoa(_IN_ADDR.pack(addr.sin_addr)), socket.ntohs(addr.sin_port))))
+        return received
@@ -1,16 +1,162 @@
+import heapq
+import itertools
+import logging
+import selectors
 import socket
 import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import mmsg
+import protocol
 from chord import Chord
-from utils import hash_function, node_info, in_range
+from utils import BufferPool, Peer, hash_function, node_info, in_range
+
+log = logging.getLogger(__name__)
+
+# One event loop thread serves the sockets of every Node in the process,
+# draining all datagrams that are ready on each wake-up, and also times their
+# periodic maintenance: a heap of (deadline, seq, interval, node, task)
+# entries whose earliest deadline bounds the select() timeout.
+_selector = selectors.DefaultSelector()
+_selector_lock = threading.Lock()
+_loop_thread = None
+_timers = []
+_timers_lock = threading.Lock()
+_timer_seq = itertools.count()
+
+# Wakes the loop when a timer is scheduled ahead of the one it is waiting for.
+_wake_recv, _wake_send = socket.socketpair()
+_wake_recv.setblocking(False)
+_wake_send.setblocking(False)
+
+# Requests that need a lookup and maintenance rounds block on RPCs to other
+# nodes, possibly to nodes served by this same process, so they run on this
+# shared pool instead of on the event loop thread. Due tasks are handed to
+# it, so a round stuck waiting on a dead peer doesn't delay the other
+# nodes' rounds.
+_workers = ThreadPoolExecutor(max_workers=16, thread_name_prefix="chord-worker")
+
+# Kernel buffer size for each node socket, large enough that a burst of
+# stabilization traffic queues up instead of being dropped, and the largest
+# datagram we expect to receive.
+_SOCKET_BUFFER = 2 * 1024 * 1024
+_DATAGRAM_SIZE = 4096
+
+def _drain_wakeups():
+    try:
+        while _wake_recv.recv(64):
+            pass
+    except BlockingIOError:
+        pass
+
+def _run_loop():
+    while True:
+        with _timers_lock:
+            timeout = max(0, _timers[0][0] - time.monotonic()) if _timers else None
+        for key, _ in _selector.select(timeout):
+            key.data()
+        now = time.monotonic()
+        due = []
+        with _timers_lock:
+            while _timers and _timers[0][0] <= now:
+                due.append(heapq.heappop(_timers))
+        for _, _, interval, node, task in due:
+            if not node.stop_event.is_set():  # Closed nodes drop out of the schedule.
+                try:
+                    _workers.submit(_run_task, node, task, interval)
+                except RuntimeError:
+                    return  # The interpreter is shutting down.
+
+def _start_loop():
+    global _loop_thread
+    with _selector_lock:
+        if _loop_thread is None:
+            _selector.register(_wake_recv, selectors.EVENT_READ, _drain_wakeups)
+            _loop_thread = threading.Thread(target=_run_loop, daemon=True)
+            _loop_thread.start()
+
+def _register(sock, callback):
+    """Watch sock for incoming datagrams, starting the event loop on first use."""
+    _start_loop()
+    with _selector_lock:
+        _selector.register(sock, selectors.EVENT_READ, callback)
+
+def _unregister(sock):
+    with _selector_lock:
+        try:
+            _selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+def _run_task(node, task, interval):
+    try:
+        task()
+    except Exception as e:
+        log.error("Error in maintenance: %s", e)
+    # Rescheduled only once this run is over, so a task never overlaps itself.
+    _schedule(node, task, interval, interval)
+
+def _schedule(node, task, interval, delay=0):
+    """Run task after delay seconds, then again interval seconds after each run, until node closes."""
+    _start_loop()
+    entry = (time.monotonic() + delay, next(_timer_seq), interval, node, task)
+    with _timers_lock:
+        heapq.heappush(_timers, entry)
+        earliest = _timers[0] is entry
+    if earliest:
+        try:
+            _wake_send.send(b"\0")
+        except BlockingIOError:
+            pass  # A wake-up is already pending.
+
+# One-way messages from every Node in the process are queued and sent by one
+# flusher thread, up to 100 per wake-up, so bursts from several handlers go
+# out in one sendmmsg call per node. Replies to RPCs are sent directly.
+_outbound = deque()
+_outbound_cond = threading.Condition()
+_flusher_thread = None
+
+def _run_flusher():
+    while True:
+        with _outbound_cond:
+            while not _outbound:
+                _outbound_cond.wait()
+            batch = [_outbound.popleft() for _ in range(min(100, len(_outbound)))]
+        by_node = {}
+        for node, data, addr in batch:
+            by_node.setdefault(node, []).append((data, addr))
+        for node, datagrams in by_node.items():
+            # One bad batch (e.g. an out-of-range port) must not stop the
+            # flusher, or every node in the process would go silent.
+            try:
+                node.sender.send(datagrams)
+            except Exception as e:
+                log.error("Error sending from node %s: %s", node.id, e)
+
+def _enqueue(messages):
+    """Queue (node, data, addr) datagrams for the flusher thread, starting it on first use."""
+    global _flusher_thread
+    with _outbound_cond:
+        _outbound.extend(messages)
+        _outbound_cond.notify()
+        if _flusher_thread is None:
+            _flusher_thread = threading.Thread(target=_run_flusher, daemon=True)
+            _flusher_thread.start()
 
 class Node:
     def __init__(self, ip, port, r=3):  # r = number of successors for fault tolerance and replication
+        # Messages carry dotted IPv4 addresses, so a hostname is resolved once here.
+        ip = socket.gethostbyname(ip)
         self.ip = ip
         self.port = port
         self.id = hash_function(f"{ip}:{port}")
+        # The messages this node sends about itself never change, so pack them once.
+        self._msg_notify = protocol.pack_id_message(protocol.NOTIFY, 0, self.id)
+        self._msg_ping = protocol.pack_header(protocol.PING)
+        self._msg_find_self = protocol.pack_id_message(protocol.FIND_SUCCESSOR, 0, self.id)
         # Initially, the node is alone in the ring.
-        self.successor = {"ip": ip, "port": port, "id": self.id}
+        self.successor = Peer(ip, port, self.id)
         self.predecessor = None
         self.data_store = {}     # Primary key-value store.
         self.replica_store = {}  # Replicated key-value store.
@@ -18,11 +164,20 @@ class Node:
         # Successor list for fault tolerance and replication.
         self.r = r
         self.successor_list = [self.successor]  # Initially only self.
+        # The successor list as last packed for a HEARTBEAT reply, and the
+        # entries it was packed from.
+        self._packed_successors = None
+        self._packed_successors_of = ()
 
-        # Temporary storage for GET_PREDECESSOR reply during stabilization.
-        self.temp_predecessor = None
-        # For detecting a failed predecessor.
-        self.last_predecessor_heartbeat = time.time()
+        # For detecting a failed predecessor: how many of our PINGs went
+        # unanswered since we last heard from it.
+        self._pred_missed_pings = 0
+
+        # Maintenance rounds since our last NOTIFY to the successor.
+        self._ticks_since_notify = 0
+
+        # Reusable receive buffers for the RPC sockets.
+        self.buffers = BufferPool(size=64, buflen=_DATAGRAM_SIZE)
 
         # Chord protocol integration.
         self.chord = Chord(self)
@@ -30,221 +185,308 @@ class Node:
         # UDP Socket setup.
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind((ip, port))
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SOCKET_BUFFER)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _SOCKET_BUFFER)
+        self.receiver = mmsg.Receiver(self.sock, buflen=_DATAGRAM_SIZE)
+        self.sender = mmsg.Sender(self.sock)
 
         # Event to signal shutdown.
         self.stop_event = threading.Event() 
-        threading.Thread(target=self.listen, daemon=True).start()
-        threading.Thread(target=self.node_stabilize, daemon=True).start()
-        threading.Thread(target=self.fix_fingers, daemon=True).start()
-        threading.Thread(target=self.check_predecessor, daemon=True).start()
+        _register(self.sock, self.listen)
+        print(f"Node {self.id} listening on {self.ip}:{self.port}")
+        _schedule(self, self.node_stabilize, 5)
 
     def listen(self):
-        """Continuously listen for incoming UDP messages and handle them."""
-        print(f"Node {self.id} listening on {self.ip}:{self.port}")
+        """Handle every UDP message waiting on the socket (called by the selector thread)."""
         while not self.stop_event.is_set():
             try:
-                data, addr = self.sock.recvfrom(1024)
-                message = data.decode()
-                # print(f"Node {self.id} received message from {addr}: {message}")
-                self.handle_message(message, addr)
+                # Up to 32 datagrams per system call (recvmmsg on Linux).
+                batch = self.receiver.recv()
+            except BlockingIOError:
+                return  # Drained.
             except OSError as e:
                 if not self.stop_event.is_set():
-                    print(f"Error in listening: {e}")
+                    log.error("Error in listening: %s", e)
+                return
+            # The datagrams are views into the receiver's buffers; handlers
+            # that keep a message past this loop copy it.
+            for data, addr in batch:
+                try:
+                    if log.isEnabledFor(logging.DEBUG):
+                        log.debug("Node %s received message from %s: %s", self.id, addr, bytes(data))
+                    self.handle_message(data, addr)
+                except Exception as e:
+                    if not self.stop_event.is_set():
+                        log.error("Error in listening: %s", e)
+
+    def in_background(self, func, *args):
+        """Run a handler that needs a lookup on the worker pool instead of the selector thread."""
+        def run():
+            try:
+                func(*args)
             except Exception as e:
                 if not self.stop_event.is_set():
-                    print(f"Error in listening: {e}")
+                    log.error("Error in listening: %s", e)
+        _workers.submit(run)
+
+    def close(self):
+        """Stop the node's threads and close its sockets."""
+        self.stop_event.set()
+        _unregister(self.sock)
+        self.sock.close()
+        self.chord.close()
 
     def send_message(self, target_ip, target_port, message):
-        """Send a UDP message to the specified target."""
-        self.sock.sendto(message.encode(), (target_ip, target_port))
+        """Queue a packed message (see protocol.py) for the specified target."""
+        _enqueue([(self, message, (target_ip, target_port))])
 
-    def handle_message(self, message, addr):
-        """Process an incoming message based on its command type."""
-        parts = message.split()
-        if not parts:
-            return
-        command = parts[0]
-
-        if command == "FIND_SUCCESSOR":
-            key_id = int(parts[1])
-            successor = self.chord.find_successor(key_id)
-            if successor:
-                self.send_message(addr[0], addr[1],
-                                  f"SUCCESSOR {successor['ip']} {successor['port']} {successor['id']}")
-        elif command == "SUCCESSOR":
-            successor_ip = parts[1]
-            successor_port = int(parts[2])
-            successor_id = int(parts[3])
-            self.successor = {"ip": successor_ip, "port": successor_port, "id": successor_id}
-            if self.successor_list:
-                self.successor_list[0] = self.successor
-            else:
-                self.successor_list = [self.successor]
-            print(f"Node {self.id} updated its successor to: {self.successor}")
-            self.send_message(self.successor["ip"], self.successor["port"], f"NOTIFY {self.id}")
-            self.chord.update_finger_table()
-        elif command == "NOTIFY":
-            potential_predecessor_id = int(parts[1])
-            if self.predecessor is None or in_range(potential_predecessor_id, self.predecessor["id"], self.id):
-                self.predecessor = {"ip": addr[0], "port": addr[1], "id": potential_predecessor_id}
-                print(f"Node {self.id} updated its predecessor to: {self.predecessor}")
-        elif command == "GET_PREDECESSOR":
-            if self.predecessor:
-                reply = f"PREDECESSOR {self.predecessor['ip']} {self.predecessor['port']} {self.predecessor['id']}"
-            else:
-                reply = "PREDECESSOR NONE"
-            self.send_message(addr[0], addr[1], reply)
-        elif command == "PREDECESSOR":
-            if parts[1] == "NONE":
-                self.temp_predecessor = None
-            else:
-                pred_ip = parts[1]
-                pred_port = int(parts[2])
-                pred_id = int(parts[3])
-                self.temp_predecessor = {"ip": pred_ip, "port": pred_port, "id": pred_id}
-        elif command == "GET_SUCCESSOR_LIST":
-            self.chord.prune_successor_list()  # Prune before replying.
-            list_str = " ".join(f"{entry['ip']} {entry['port']} {entry['id']}" for entry in self.successor_list)
-            reply = f"SUCCESSOR_LIST {list_str}"
-            self.send_message(addr[0], addr[1], reply)
-        elif command == "SUCCESSOR_LIST":
-            new_list = []
-            num_entries = (len(parts) - 1) // 3
-            for i in range(num_entries):
-                entry_ip = parts[1 + 3*i]
-                entry_port = int(parts[2 + 3*i])
-                entry_id = int(parts[3 + 3*i])
-                new_list.append({"ip": entry_ip, "port": entry_port, "id": entry_id})
-            if new_list:
-                self.successor_list = [self.successor]  # Ensure immediate successor is first.
-                for entry in new_list:
-                    if entry["id"] != self.id and len(self.successor_list) < self.r:
-                        self.successor_list.append(entry)
-                print(f"Node {self.id} updated its successor list to: {self.successor_list}")
-        elif command == "UPDATE_PREDECESSOR_TO":
-            new_pred_ip = parts[1]
-            new_pred_port = int(parts[2])
-            new_pred_id = int(parts[3])
-            self.predecessor = {"ip": new_pred_ip, "port": new_pred_port, "id": new_pred_id}
-            print(f"Node {self.id} updated predecessor to Node {self.predecessor['id']}")
-        elif command == "UPDATE_SUCCESSOR_TO":
-            new_succ_ip = parts[1]
-            new_succ_port = int(parts[2])
-            new_succ_id = int(parts[3])
-            self.successor = {"ip": new_succ_ip, "port": new_succ_port, "id": new_succ_id}
-            if self.successor_list:
-                self.successor_list[0] = self.successor
-            print(f"Node {self.id} updated successor to Node {self.successor['id']}")
-        elif command == "STORE":
-            key = parts[1]
-            value = parts[2]
-            key_id = hash_function(key)
-            successor = self.chord.find_successor(key_id)
-            if successor["id"] == self.id:
-                self.data_store[key] = value
-                print(f"Node {self.id} stored key-value: {key}: {value}")
-                for s in self.successor_list[1:]:
-                    self.send_message(s["ip"], s["port"], f"REPLICATE {key} {value}")
-            else:
-                self.send_message(successor["ip"], successor["port"], message)
-        elif command == "REPLICATE":
-            key = parts[1]
-            value = parts[2]
-            self.replica_store[key] = value
-            print(f"Node {self.id} stored replicated key-value: {key}: {value}")
-        elif command == "LOOKUP":
-            key = parts[1]
-            key_id = hash_function(key)
-            successor = self.chord.find_successor(key_id)
-            if successor["id"] == self.id:
-                value = self.data_store.get(key, None)
-                if value is None:
-                    value = self.replica_store.get(key, "NOT_FOUND")
-                self.send_message(addr[0], addr[1], f"RESULT {key} {value}")
+    def send_to(self, target, message):
+        """Queue a packed message for a known node (a Peer)."""
+        _enqueue([(self, message, target.addr)])
+
+    def send_messages(self, messages):
+        """Queue several packed messages, given as (target, message) pairs, together."""
+        _enqueue([(self, message, target.addr) for target, message in messages])
+
+    def reply(self, addr, data):
+        """Send an already packed reply to addr."""
+        self.sock.sendto(data, addr)
+
+    def reply_successor(self, key_id, token, addr):
+        successor = self.chord.find_successor(key_id, alpha=1)
+        if successor:
+            self.reply(addr, protocol.pack_node_message(protocol.SUCCESSOR, token, successor))
+
+    # Requests forwarded from another node pass alpha=1, so the parallel
+    # fan-out only happens at the node where the request started.
+    def route_store(self, key_id, key, value, message, alpha=None):
+        successor = self.chord.find_successor(key_id, alpha)
+        if successor.id == self.id:
+            self.data_store[key] = value
+            log.info("Node %s stored key-value: %s: %s", self.id, key, value)
+            replicate = protocol.pack_replicate(key, value)
+            self.send_messages([(s, replicate) for s in self.successor_list[1:]])
+        else:
+            self.send_to(successor, message)
+
+    def route_lookup(self, key_id, key, origin, message, alpha=None):
+        successor = self.chord.find_successor(key_id, alpha)
+        if successor.id == self.id:
+            value = self.data_store.get(key, None)
+            if value is None:
+                value = self.replica_store.get(key, "NOT_FOUND")
+            if origin == (self.ip, self.port):
+                print(f"Lookup result for {key}: {value}")
             else:
-                self.send_message(successor["ip"], successor["port"], message)
-        elif command == "PING":
-            self.send_message(addr[0], addr[1], "PONG")
-            if (self.predecessor and addr[0] == self.predecessor["ip"] and addr[1] == self.predecessor["port"]):
-                self.last_predecessor_heartbeat = time.time()
-        elif command == "PONG":
-            if (self.predecessor and addr[0] == self.predecessor["ip"] and addr[1] == self.predecessor["port"]):
-                self.last_predecessor_heartbeat = time.time()
-        elif command == "RESULT":
-            key = parts[1]
-            value = parts[2]
-            print(f"Lookup result for {key}: {value}")
+                # The result goes straight back to the node the lookup started at.
+                self.send_message(origin[0], origin[1], protocol.pack_result(key, value))
+        else:
+            self.send_to(successor, message)
+
+    def handle_message(self, data, addr):
+        """Process an incoming request or reply by dispatching on its opcode."""
+        # Requests made through Chord.call carry a token that must be echoed
+        # back in the reply; all other messages carry 0.
+        op, token, payload = protocol.unpack_message(data)
+        handler = self._DISPATCH.get(op)
+        if handler:
+            handler(self, token, payload, data, addr)
+
+    def _handle_find_successor(self, token, key_id, data, addr):
+        self.in_background(self.reply_successor, key_id, token, addr)
+
+    def _handle_notify(self, token, potential_predecessor_id, data, addr):
+        if self.predecessor is None or in_range(potential_predecessor_id, self.predecessor.id, self.id):
+            self.predecessor = Peer(addr[0], addr[1], potential_predecessor_id)
+            self._predecessor_heard()
+            self.chord.clear_cache()
+            log.info("Node %s updated its predecessor to: %s", self.id, self.predecessor)
+
+    def _handle_heartbeat_request(self, token, payload, data, addr):
+        # Our successor list is pruned by our own stabilization, so there is
+        # no need to ping its entries again before replying.
+        self.reply(addr, protocol.pack_heartbeat_reply(token, self.predecessor, self._pack_successors()))
+
+    def _pack_successors(self):
+        """Return the packed successor list, repacking it only after it changed."""
+        # Peers compare by identity, so this is a cheap check that catches
+        # both reassignment of the list and in-place updates to it.
+        successors = tuple(self.successor_list)
+        if successors != self._packed_successors_of:
+            self._packed_successors = protocol.pack_node_list(successors)
+            self._packed_successors_of = successors
+        return self._packed_successors
+
+    def _handle_update_predecessor_to(self, token, predecessor, data, addr):
+        self.predecessor = predecessor
+        self._predecessor_heard()
+        log.info("Node %s updated predecessor to Node %s", self.id, self.predecessor.id)
+
+    def _handle_update_successor_to(self, token, successor, data, addr):
+        self.successor = successor
+        if self.successor_list:
+            self.successor_list[0] = self.successor
+        log.info("Node %s updated successor to Node %s", self.id, self.successor.id)
+
+    def _handle_store(self, token, payload, data, addr):
+        # The key is hashed once by the originating node and its id travels
+        # with the request, so forwarding hops don't hash it again.
+        key_id, key, value = payload
+        self.in_background(self.route_store, key_id, key, value, bytes(data), 1)
+
+    def _handle_replicate(self, token, payload, data, addr):
+        key, value = payload
+        self.replica_store[key] = value
+        log.debug("Node %s stored replicated key-value: %s: %s", self.id, key, value)
+
+    def _handle_bulk_store(self, token, entries, data, addr):
+        # Sent by a leaving node: each key is routed like a STORE.
+        for key_id, key, value in entries:
+            self.in_background(self.route_store, key_id, key, value, protocol.pack_store(key_id, key, value), 1)
+
+    def _handle_bulk_replicate(self, token, entries, data, addr):
+        self.replica_store.update(entries)
+        log.debug("Node %s stored %s replicated key-values", self.id, len(entries))
+
+    def _handle_lookup(self, token, payload, data, addr):
+        key_id, origin, key = payload
+        self.in_background(self.route_lookup, key_id, key, origin, bytes(data), 1)
+
+    def _handle_ping(self, token, payload, data, addr):
+        self.reply(addr, protocol.pack_header(protocol.PONG, token))
+        if self.predecessor and addr == self.predecessor.addr:
+            self._predecessor_heard()
+
+    def _handle_result(self, token, payload, data, addr):
+        key, value = payload
+        print(f"Lookup result for {key}: {value}")
+
+    def _handle_successor(self, token, successor, data, addr):
+        # Reply to the FIND_SUCCESSOR sent by join().
+        self.successor = successor
+        if self.successor_list:
+            self.successor_list[0] = self.successor
+        else:
+            self.successor_list = [self.successor]
+        log.info("Node %s updated its successor to: %s", self.id, self.successor)
+        self.send_to(self.successor, self._msg_notify)
+        self.in_background(self.chord.update_finger_table)
+
+    def _handle_pong(self, token, payload, data, addr):
+        # Reply to check_predecessor's PING.
+        if self.predecessor and addr == self.predecessor.addr:
+            self._predecessor_heard()
+
+    def _predecessor_heard(self):
+        self._pred_missed_pings = 0
+
+    # Opcode -> handler, built once for the class.
+    _DISPATCH = {
+        protocol.FIND_SUCCESSOR: _handle_find_successor,
+        protocol.NOTIFY: _handle_notify,
+        protocol.HEARTBEAT_REQUEST: _handle_heartbeat_request,
+        protocol.UPDATE_PREDECESSOR_TO: _handle_update_predecessor_to,
+        protocol.UPDATE_SUCCESSOR_TO: _handle_update_successor_to,
+        protocol.STORE: _handle_store,
+        protocol.REPLICATE: _handle_replicate,
+        protocol.BULK_STORE: _handle_bulk_store,
+        protocol.BULK_REPLICATE: _handle_bulk_replicate,
+        protocol.LOOKUP: _handle_lookup,
+        protocol.PING: _handle_ping,
+        protocol.RESULT: _handle_result,
+        protocol.SUCCESSOR: _handle_successor,
+        protocol.PONG: _handle_pong,
+    }
 
     def join(self, known_node_ip, known_node_port):
+        try:
+            known_node_ip = socket.gethostbyname(known_node_ip)
+        except OSError as e:
+            print(f"Error: cannot resolve {known_node_ip}: {e}")
+            return
         if known_node_ip == self.ip and known_node_port == self.port:
             self.predecessor = None
-            self.successor = {"ip": self.ip, "port": self.port, "id": self.id}
+            self.successor = Peer(self.ip, self.port, self.id)
             self.successor_list = [self.successor]
             print(f"Node {self.id} initialized as the first node in the ring.")
         else:
             print(f"Node {self.id} joining ring via {known_node_ip}:{known_node_port}")
-            self.send_message(known_node_ip, known_node_port, f"FIND_SUCCESSOR {self.id}")
+            self.send_message(known_node_ip, known_node_port, self._msg_find_self)
 
     def node_stabilize(self):
-        while not self.stop_event.is_set():
-            # Prune the successor list before using it.
-            self.chord.prune_successor_list()
-            self.chord.stabilize()
-            # Update successor list from our immediate successor.
-            self.chord.update_successor_list()
-            self.send_message(self.successor["ip"], self.successor["port"], f"NOTIFY {self.id}")
-            self.chord.update_finger_table()
-            time.sleep(5)
-
-    def fix_fingers(self):
-        while not self.stop_event.is_set():
-            self.chord.update_finger_table()
-            time.sleep(5)
+        """One maintenance round; scheduled every 5 seconds."""
+        # The predecessor check shares this tick rather than having its own
+        # timer. It only queues a PING, so it goes first and isn't held up by
+        # the RPCs below.
+        self.check_predecessor()
+        # Prune the successor list before using it.
+        self.chord.prune_successor_list()
+        # Also refreshes the successor list from our immediate successor.
+        self.chord.stabilize()
+        # NOTIFY only when our successor doesn't already have us as its
+        # predecessor, plus every 6th round (30 s) as a keepalive.
+        if self.chord.successor_knows_us and self._ticks_since_notify < 5:
+            self._ticks_since_notify += 1
+        else:
+            self.send_to(self.successor, self._msg_notify)
+            self._ticks_since_notify = 0
+        self.chord.update_finger_table()
 
     def check_predecessor(self):
-        while not self.stop_event.is_set():
-            if self.predecessor:
-                # If the predecessor is self, we don't need to ping
-                if self.predecessor["id"] == self.id:
-                    self.last_predecessor_heartbeat = time.time()
+        """One predecessor liveness check; part of each maintenance round."""
+        if self.predecessor:
+            # If the predecessor is self, we don't need to ping
+            if self.predecessor.id == self.id:
+                self._predecessor_heard()
+            else:
+                # A single lost datagram isn't a failure: the predecessor is
+                # only given up after three PINGs in a row go unanswered.
+                if self._pred_missed_pings < 3:
+                    self._pred_missed_pings += 1
+                    self.send_to(self.predecessor, self._msg_ping)
                 else:
-                    self.send_message(self.predecessor["ip"], self.predecessor["port"], "PING")
-                    if time.time() - self.last_predecessor_heartbeat > 15:
-                        print(f"Node {self.id} detected failed predecessor {self.predecessor}")
-                        # If the predecessor fails, and if this node is alone,
-                        # then we update our predecessor to self.
-                        if self.successor["id"] == self.id:
-                            self.predecessor = {"ip": self.ip, "port": self.port, "id": self.id}
-                        else:
-                            self.predecessor = None
-            time.sleep(5)
+                    log.warning("Node %s detected failed predecessor %s", self.id, self.predecessor)
+                    # If the predecessor fails, and if this node is alone,
+                    # then we update our predecessor to self.
+                    if self.successor.id == self.id:
+                        self.predecessor = Peer(self.ip, self.port, self.id)
+                    else:
+                        self.predecessor = None
 
+    # Local requests are routed in-process rather than sent to our own socket.
+    # The packed message is only sent if the key belongs to another node.
     def store(self, key, value):
-        self.send_message(self.ip, self.port, f"STORE {key} {value}")
+        key_id = hash_function(key)
+        self.in_background(self.route_store, key_id, key, value, protocol.pack_store(key_id, key, value))
 
     def lookup(self, key):
-        self.send_message(self.ip, self.port, f"LOOKUP {key}")
+        key_id = hash_function(key)
+        origin = (self.ip, self.port)
+        self.in_background(self.route_lookup, key_id, key, origin, protocol.pack_lookup(key_id, origin, key))
 
     def leave(self):
         print(f"Node {self.id} leaving the network.")
-        if self.successor and self.successor["id"] != self.id:
-            for key, value in self.data_store.items():
-                self.send_message(self.successor["ip"], self.successor["port"], f"STORE {key} {value}")
-            for key, value in self.replica_store.items():
-                self.send_message(self.successor["ip"], self.successor["port"], f"REPLICATE {key} {value}")
-            print(f"Node {self.id} transferred data to successor {self.successor['id']}")
-            self.send_message(self.successor["ip"], self.successor["port"], 
-            f"UPDATE_PREDECESSOR_TO {self.predecessor['ip']} {self.predecessor['port']} {self.predecessor['id']}")
-        if self.predecessor and self.predecessor["id"] != self.id:
-            self.send_message(self.predecessor["ip"], self.predecessor["port"], 
-            f"UPDATE_SUCCESSOR_TO {self.successor['ip']} {self.successor['port']} {self.successor['id']}")
+        if self.successor and self.successor.id != self.id:
+            # The keys travel packed several to a datagram, followed by the
+            # predecessor update (if we have a predecessor) in the same batch.
+            transfers = protocol.pack_bulk_store([(hash_function(key), key, value)
+                                                  for key, value in self.data_store.items()])
+            transfers += protocol.pack_bulk_replicate(self.replica_store.items())
+            if self.predecessor:
+                transfers.append(protocol.pack_node_message(protocol.UPDATE_PREDECESSOR_TO, 0, self.predecessor))
+            self.send_messages([(self.successor, message) for message in transfers])
+            print(f"Node {self.id} transferred data to successor {self.successor.id}")
+        if self.predecessor and self.predecessor.id != self.id:
+            self.send_to(self.predecessor,
+            protocol.pack_node_message(protocol.UPDATE_SUCCESSOR_TO, 0, self.successor))
         time.sleep(0.5)
 
         # Reset node state to an isolated state so it can rejoin later if desired
         self.predecessor = None
-        self.successor = {"ip": self.ip, "port": self.port, "id": self.id}
+        self.successor = Peer(self.ip, self.port, self.id)
         self.successor_list = [self.successor]
-        self.chord.finger_table = [self.successor for _ in range(self.chord.m)]
+        self.chord.reset_finger_table()
         
         # self.stop_event.set()
         print(f"Node {self.id} has exited the Chord ring.")
@@ -252,6 +494,7 @@ class Node:
 
 # --- For testing purposes ---
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     node1 = Node("127.0.0.1", 5000)
     node2 = Node("127.0.0.1", 5001)
     
@@ -0,0 +1,231 @@
+import socket
+import struct
+from utils import Peer
+
+# Binary encoding of the messages nodes exchange.
+#
+# Every message starts with a 1-byte opcode and a 4-byte token. Requests made
+# through Chord.call carry a token that the reply echoes; everything else uses
+# 0. Replies have opcodes below 0x20 and requests 0x20 and above, so a node can
+# tell them apart from the first byte. A node reference is packed as IPv4
+# address, port and id (ids must fit in 64 bits, i.e. m <= 64). Keys and
+# values are UTF-8 strings prefixed with their 2-byte length. Bulk messages
+# carry a 2-byte entry count and are split so each datagram stays within
+# MAX_BULK_DATAGRAM bytes.
+
+# Replies
+SUCCESSOR = 1  # <node>
+HEARTBEAT = 2  # <0|1> [<predecessor node>] <count> <successor node> * count
+PONG = 3       # no payload
+
+# Requests
+FIND_SUCCESSOR = 0x20         # <key id>
+NOTIFY = 0x21                 # <node id>
+HEARTBEAT_REQUEST = 0x22      # no payload
+PING = 0x23                   # no payload
+UPDATE_PREDECESSOR_TO = 0x24  # <node>
+UPDATE_SUCCESSOR_TO = 0x25    # <node>
+STORE = 0x26                  # <key id> <key> <value>
+REPLICATE = 0x27              # <key> <value>
+LOOKUP = 0x28                 # <key id> <origin ip> <origin port> <key>
+RESULT = 0x29                 # <key> <value>
+BULK_STORE = 0x2A             # <count> (<key id> <key> <value>) * count
+BULK_REPLICATE = 0x2B         # <count> (<key> <value>) * count
+
+# Fits an Ethernet MTU with IP and UDP headers to spare.
+MAX_BULK_DATAGRAM = 1400
+
+_HEADER = struct.Struct("!BI")
+_NODE = struct.Struct("!4sHQ")
+_COUNT = struct.Struct("!B")
+_ID = struct.Struct("!Q")
+_ADDR = struct.Struct("!4sH")
+_LENGTH = struct.Struct("!H")
+
+# One-way messages always carry token 0, so their headers are packed once.
+_STORE_HEADER = _HEADER.pack(STORE, 0)
+_REPLICATE_HEADER = _HEADER.pack(REPLICATE, 0)
+_LOOKUP_HEADER = _HEADER.pack(LOOKUP, 0)
+_RESULT_HEADER = _HEADER.pack(RESULT, 0)
+_BULK_STORE_HEADER = _HEADER.pack(BULK_STORE, 0)
+_BULK_REPLICATE_HEADER = _HEADER.pack(BULK_REPLICATE, 0)
+
+
+def is_reply(data):
+    """Return True if the datagram is a reply rather than a request."""
+    return len(data) > 0 and data[0] < 0x20
+
+
+def with_token(message, token):
+    """Return a copy of a packed request carrying the given token."""
+    return _HEADER.pack(message[0], token) + message[_HEADER.size:]
+
+
+def _pack_node(node):
+    return _NODE.pack(socket.inet_aton(node.ip), node.port, node.id)
+
+
+def _unpack_node(data, offset):
+    ip, port, id = _NODE.unpack_from(data, offset)
+    return Peer(socket.inet_ntoa(ip), port, id)
+
+
+def _pack_str(text):
+    data = text.encode()
+    return _LENGTH.pack(len(data)) + data
+
+
+def _unpack_str(data, offset):
+    length, = _LENGTH.unpack_from(data, offset)
+    start = offset + _LENGTH.size
+    if start + length > len(data):
+        raise struct.error("string runs past the end of the message")
+    # str() decodes straight from the buffer, so a memoryview slice isn't
+    # copied into a bytes object first.
+    return str(data[start:start + length], "utf-8"), start + length
+
+
+def pack_header(op, token=0):
+    """Pack a message without payload (PONG, PING, HEARTBEAT_REQUEST)."""
+    return _HEADER.pack(op, token or 0)
+
+
+def pack_node_message(op, token, node):
+    """Pack a message carrying one node reference (SUCCESSOR, UPDATE_*_TO)."""
+    return _HEADER.pack(op, token or 0) + _pack_node(node)
+
+
+def pack_id_message(op, token, id):
+    """Pack a message carrying one id (FIND_SUCCESSOR, NOTIFY)."""
+    return _HEADER.pack(op, token or 0) + _ID.pack(id)
+
+
+def pack_node_list(nodes):
+    """Pack a list of node references as a count followed by the nodes."""
+    return _COUNT.pack(len(nodes)) + b"".join(_pack_node(node) for node in nodes)
+
+
+def pack_heartbeat_reply(token, predecessor, packed_successors):
+    """
+    Pack a HEARTBEAT reply: our predecessor (may be None) and our successor
+    list, the latter already packed with pack_node_list.
+    """
+    if predecessor:
+        pred = _COUNT.pack(1) + _pack_node(predecessor)
+    else:
+        pred = _COUNT.pack(0)
+    return b"".join((_HEADER.pack(HEARTBEAT, token or 0), pred, packed_successors))
+
+
+def pack_store(key_id, key, value):
+    return b"".join((_STORE_HEADER, _ID.pack(key_id), _pack_str(key), _pack_str(value)))
+
+
+def pack_replicate(key, value):
+    return b"".join((_REPLICATE_HEADER, _pack_str(key), _pack_str(value)))
+
+
+def pack_lookup(key_id, origin, key):
+    """Pack a LOOKUP; origin is the (ip, port) the RESULT should be sent to."""
+    return b"".join((_LOOKUP_HEADER, _ID.pack(key_id),
+                     _ADDR.pack(socket.inet_aton(origin[0]), origin[1]), _pack_str(key)))
+
+
+def pack_result(key, value):
+    return b"".join((_RESULT_HEADER, _pack_str(key), _pack_str(value)))
+
+
+def _pack_bulk(header, entries):
+    messages = []
+    batch = []
+    size = len(header) + _LENGTH.size
+    for entry in entries:
+        if batch and (size + len(entry) > MAX_BULK_DATAGRAM or len(batch) == 0xFFFF):
+            messages.append(b"".join([header, _LENGTH.pack(len(batch))] + batch))
+            batch = []
+            size = len(header) + _LENGTH.size
+        batch.append(entry)  # An entry too large for any datagram goes out alone.
+        size += len(entry)
+    if batch:
+        messages.append(b"".join([header, _LENGTH.pack(len(batch))] + batch))
+    return messages
+
+
+def pack_bulk_store(entries):
+    """Pack (key id, key, value) triples into as few BULK_STORE messages as fit; returns a list."""
+    return _pack_bulk(_BULK_STORE_HEADER, [_ID.pack(key_id) + _pack_str(key) + _pack_str(value)
+                                           for key_id, key, value in entries])
+
+
+def pack_bulk_replicate(entries):
+    """Pack (key, value) pairs into as few BULK_REPLICATE messages as fit; returns a list."""
+    return _pack_bulk(_BULK_REPLICATE_HEADER, [_pack_str(key) + _pack_str(value) for key, value in entries])
+
+
+def unpack_message(data):
+    """
+    Unpack a message.
+
+    :param data: The received datagram.
+    :return: (opcode, token, payload) where payload is
+             - a Peer for SUCCESSOR and UPDATE_*_TO,
+             - a (predecessor or None, successor list) pair for HEARTBEAT,
+             - an id for FIND_SUCCESSOR and NOTIFY,
+             - (key id, key, value) for STORE,
+             - (key id, origin (ip, port), key) for LOOKUP,
+             - (key, value) for REPLICATE and RESULT,
+             - a list of (key id, key, value) for BULK_STORE,
+             - a list of (key, value) for BULK_REPLICATE,
+             - None otherwise.
+    :raises struct.error: If the datagram is truncated.
+    """
+    op, token = _HEADER.unpack_from(data)
+    offset = _HEADER.size
+    if op in (SUCCESSOR, UPDATE_PREDECESSOR_TO, UPDATE_SUCCESSOR_TO):
+        payload = _unpack_node(data, offset)
+    elif op in (FIND_SUCCESSOR, NOTIFY):
+        payload, = _ID.unpack_from(data, offset)
+    elif op == HEARTBEAT:
+        has_pred, = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        predecessor = None
+        if has_pred:
+            predecessor = _unpack_node(data, offset)
+            offset += _NODE.size
+        count, = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        end = offset + count * _NODE.size
+        if end > len(data):
+            raise struct.error("successor list runs past the end of the message")
+        successors = [Peer(socket.inet_ntoa(ip), port, id)
+                      for ip, port, id in _NODE.iter_unpack(data[offset:end])]
+        payload = (predecessor, successors)
+    elif op == STORE:
+        key_id, = _ID.unpack_from(data, offset)
+        key, offset = _unpack_str(data, offset + _ID.size)
+        value, _ = _unpack_str(data, offset)
+        payload = (key_id, key, value)
+    elif op == LOOKUP:
+        key_id, = _ID.unpack_from(data, offset)
+        offset += _ID.size
+        ip, port = _ADDR.unpack_from(data, offset)
+        key, _ = _unpack_str(data, offset + _ADDR.size)
+        payload = (key_id, (socket.inet_ntoa(ip), port), key)
+    elif op in (REPLICATE, RESULT):
+        key, offset = _unpack_str(data, offset)
+        value, _ = _unpack_str(data, offset)
+        payload = (key, value)
+    elif op in (BULK_STORE, BULK_REPLICATE):
+        count, = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        payload = []
+        for _ in range(count):
+            if op == BULK_STORE:
+                key_id, = _ID.unpack_from(data, offset)
+                offset += _ID.size
+            key, offset = _unpack_str(data, offset)
+            value, offset = _unpack_str(data, offset)
+            payload.append((key_id, key, value) if op == BULK_STORE else (key, value))
+    else:
+        payload = None
+    return op, token, payload
@@ -1,10 +1,72 @@
+import functools
 import hashlib
+import threading
+from collections import deque
 
+# Fresh SHA-1 state that hash_function copies instead of constructing a new
+# hash object for every key.
+_SHA1 = hashlib.sha1()
+
+@functools.lru_cache(maxsize=8192)
 def hash_function(key, m=8):
     """
     Hashes a key using SHA-1 and returns an m-bit integer.
+    Results are memoized (bounded LRU), so storing or looking up the same key
+    again doesn't rehash it.
+    """
+    h = _SHA1.copy()
+    h.update(key if isinstance(key, bytes) else key.encode())
+    digest = h.digest()
+    if m <= 8:
+        # The id fits in the last digest byte; no int conversion needed.
+        return digest[-1] & ((1 << m) - 1)
+    # Only the trailing bytes covering the low m bits are converted; masking
+    # them gives the same id as the full digest modulo 2**m.
+    return int.from_bytes(digest[-((m + 7) // 8):], "big") & ((1 << m) - 1)
+
+class Peer:
+    """
+    Reference to a node in the ring. Uses __slots__ so the ip/port/id reads
+    in the routing code are plain attribute loads rather than dict lookups.
+    addr is the (ip, port) tuple, built once for every datagram sent to it.
     """
-    return int(hashlib.sha1(key.encode()).hexdigest(), 16) % (2 ** m)
+    __slots__ = ("ip", "port", "id", "addr")
+
+    def __init__(self, ip, port, id):
+        self.ip = ip
+        self.port = port
+        self.id = id
+        self.addr = (ip, port)
+
+    def __repr__(self):
+        return f"Peer(ip={self.ip!r}, port={self.port}, id={self.id})"
+
+class BufferPool:
+    """
+    A thread-safe pool of reusable bytearray buffers for recvfrom_into, so
+    receiving a datagram doesn't allocate a fresh bytes object.
+    """
+    def __init__(self, size=64, buflen=2048):
+        self.buflen = buflen
+        self._free = deque(bytearray(buflen) for _ in range(size))
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Take a buffer from the pool, allocating a new one if the pool is empty."""
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return bytearray(self.buflen)
+
+    def put(self, buf):
+        """Return a buffer taken with get() to the pool."""
+        with self._lock:
+            self._free.append(buf)
+
+# Ids travel as 64-bit integers (see protocol.py). Reducing differences modulo
+# 2**64 orders them the same way as modulo 2**m for any m <= 64, so one mask
+# serves every ring size.
+_ID_MASK = (1 << 64) - 1
 
 def in_range(x, start, end, include_end=False):
     """
@@ -16,11 +78,11 @@ def in_range(x, start, end, include_end=False):
     :param include_end: If True, use (start, end] instead of (start, end).
     :return: True if x is in the interval, False otherwise.
     """
-    if start < end:
-        return start < x <= end if include_end else start < x < end
-    else:
-        # Wrap-around case: the interval spans the end of the ID space.
-        return (x > start or x <= end) if include_end else (x > start or x < end)
+    # Distances past start, so the wrap-around case needs no separate branch.
+    # start == end covers the whole ring (except start itself when open).
+    if include_end:
+        return ((x - start - 1) & _ID_MASK) <= ((end - start - 1) & _ID_MASK)
+    return ((x - start - 1) & _ID_MASK) < ((end - start - 1) & _ID_MASK)
 
 def display_finger_table(node):
     """
@@ -35,7 +97,7 @@ def display_finger_table(node):
         start = (node.id + 2 ** i) % (2 ** m)
         end = (node.id + 2 ** (i + 1)) % (2 ** m)
         successor = node.chord.finger_table[i]
-        successor_id = successor["id"] if successor else "None"
+        successor_id = successor.id if successor else "None"
         interval = f"[{start}, {end})" if start < end else f"[{start}, {2**m}) U [0, {end})"
         print("{:<10} {:<20} {:<15}".format(start, interval, successor_id))
 
@@ -50,14 +112,15 @@ def node_info(node):
     print(f"Node ID       : {node.id}")
     print(f"IP Address    : {node.ip}")
     print(f"Port          : {node.port}")
-    print(f"Successor ID  : {node.successor['id'] if node.successor else 'None'}")
-    print(f"Predecessor ID: {node.predecessor['id'] if node.predecessor else 'None'}")
+    print(f"Successor ID  : {node.successor.id if node.successor else 'None'}")
+    print(f"Predecessor ID: {node.predecessor.id if node.predecessor else 'None'}")
     # Display the full successor list:
     if hasattr(node, 'successor_list') and node.successor_list:
-        succ_list_ids = [entry['id'] for entry in node.successor_list]
+        succ_list_ids = [entry.id for entry in node.successor_list]
         print(f"Successor List: {succ_list_ids}")
     else:
         print("Successor List: None")
+    print(f"Lookup cache  : {node.chord.cache_hits} hits, {node.chord.cache_misses} misses")
     print("=" * 24)
     display_finger_table(node)
 